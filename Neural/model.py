@@ -54,8 +54,9 @@ class Model(object):
 		self.scheduler.step(valid_loss)
 
 	def update(self, batch, penalty=False, weight=1.0):
-		inputs = [p.to(self.device) for p in batch[:5]]
-		labels = batch[5].to(self.device)
+		feats = batch[0].to(self.device, non_blocking=True)
+		inputs = utils.unpack_feats(feats)
+		labels = batch[1].to(self.device, non_blocking=True)
 		self.model.train()
 		logits = self.model(inputs)
 		loss = self.criterion(logits, labels)
@@ -76,18 +77,18 @@ class Model(object):
 		self.model.flinear.bias.data = bias
 
 	def predict(self, batch):
-		inputs = [p.to(self.device) for p in batch[:5]]
-		labels = batch[5].to(self.cpu)
-		orig_idx = batch[6]
+		feats = batch[0].to(self.device, non_blocking=True)
+		inputs = utils.unpack_feats(feats)
+		labels = batch[1].to(self.cpu)
 		logits = self.model(inputs).to(self.cpu)
 		loss = self.criterion(logits, labels)
 		pred = torch.argmax(logits, dim=1).to(self.cpu)
 		# corrects = torch.eq(pred, labels)
 		# acc_cnt = torch.sum(corrects, dim=-1)
-		recover_idx = utils.recover_idx(orig_idx)
-		logits = [logits[idx].tolist() for idx in recover_idx]
-		pred = [pred[idx].item() for idx in recover_idx]
-		labels = [labels[idx].item() for idx in recover_idx]
+		# batches are no longer sorted by length, so outputs are already in input order
+		logits = logits.tolist()
+		pred = pred.tolist()
+		labels = labels.tolist()
 		return logits, pred, labels, loss.item()
 
 	def eval(self, dset, vocab=None, output_false_file=None, output_label_file=None, weights=None):
@@ -109,8 +110,9 @@ class Model(object):
 			loss += loss_b
 
 			if output_false_file is not None and vocab is not None:
-				all_words, pos, ner, subj_pos, obj_pos, labels_, _ = batch
-				all_words = all_words.tolist()
+				feats = batch[0]
+				all_words = feats[:, 0].tolist()
+				subj_pos, obj_pos = feats[:, 3], feats[:, 4]
 				output_false_file.write('\n')
 				for i, word_ids in enumerate(all_words):
 					if labels[i] != pred[i]:
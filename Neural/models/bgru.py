@@ -93,7 +93,7 @@ class BGRU(nn.Module):
 		input = torch.cat(input_embs, dim=2).contiguous()
 		input = self.input_dropout(input)
 
-		input = nn.utils.rnn.pack_padded_sequence(input, seq_lens, batch_first=True)
+		input = nn.utils.rnn.pack_padded_sequence(input, seq_lens, batch_first=True, enforce_sorted=False)
 		output, hn = self.gru(input)  # default: zero state
 		output, output_lens = nn.utils.rnn.pad_packed_sequence(output, batch_first=True)
 
@@ -97,9 +97,11 @@ class PositionAwareRNN(nn.Module):
 
 		# rnn
 		h0, c0 = self.zero_state(batch_size)
-		inputs = nn.utils.rnn.pack_padded_sequence(inputs, seq_lens, batch_first=True)
+		inputs = nn.utils.rnn.pack_padded_sequence(inputs, seq_lens, batch_first=True, enforce_sorted=False)
 		outputs, (ht, ct) = self.rnn(inputs, (h0, c0))
-		outputs, output_lens = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True)
+		# unpack back to the full padded width, so outputs line up with the masks
+		# and position features even when the batch is padded past max(seq_lens)
+		outputs, output_lens = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True, total_length=words.size(1))
 		hidden = self.output_drop(ht[-1,:,:]) # get the outmost layer h_n
 		outputs = self.output_drop(outputs)
 
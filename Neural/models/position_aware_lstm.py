@@ -72,9 +72,11 @@ class PositionAwareLSTM(nn.Module):
 
 		input = torch.cat([emb_words, emb_pos, emb_ner], dim=2)
 
-		input = nn.utils.rnn.pack_padded_sequence(input, seq_lens, batch_first=True)
+		input = nn.utils.rnn.pack_padded_sequence(input, seq_lens, batch_first=True, enforce_sorted=False)
 		output, (hn, cn) = self.lstm(input)  # default: zero state
-		output, output_lens = nn.utils.rnn.pad_packed_sequence(output, batch_first=True)
+		# unpack back to the full padded width, so the output lines up with the
+		# masks and position features even when the batch is padded past max(seq_lens)
+		output, output_lens = nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=maxlen)
 
 		output = self.dropout(output)
 
@@ -31,10 +31,10 @@ def train(args):
 		if args.fix_bias:
 			model.set_bias(train_lp)
 
-		for idx, batch in enumerate(tqdm(train_dset.batched_data)):
+		for idx, batch in enumerate(tqdm(train_loader)):
 			loss_batch = model.update(batch)
 			loss += loss_batch
-		loss /= len(train_dset.batched_data)
+		loss /= len(train_loader)
 
 		valid_loss, (dev_prec, dev_recall, dev_f1) = model.eval(dev_dset)
 		logging.info('Iteration %d, Train loss %f' % (iter, loss))
@@ -102,6 +102,8 @@ if __name__ == '__main__':
 	parser.add_argument('--no-lower', dest='lower', action='store_false')
 	parser.set_defaults(lower=False)
 	parser.add_argument('--batch_size', type=int, default=64)
+	parser.add_argument('--num_workers', type=int, default=2, help='Number of DataLoader worker processes.')
+	parser.add_argument('--preprocess_workers', type=int, default=0, help='Number of processes for instance preprocessing (0 for single-process).')
 
 	# Optimization
 	parser.add_argument('--lr', type=float, default=1.0, help='Applies to SGD and Adagrad.')
@@ -160,6 +162,7 @@ if __name__ == '__main__':
 	test_filename = '%s/test.json' % args.data_dir
 	dev_filename = '%s/dev.json' % args.data_dir
 	train_dset = Dataset(train_filename, args, word2id, device, rel2id=rel2id, shuffle=True, mask_with_type=args.mask_with_type)
+	train_loader = train_dset.loader(num_workers=args.num_workers)
 	dev_dset = Dataset(dev_filename, args, word2id, device, rel2id=rel2id, mask_with_type=args.mask_with_type)
 	test_dset = Dataset(test_filename, args, word2id, device, rel2id=rel2id, mask_with_type=args.mask_with_type)
 
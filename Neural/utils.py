@@ -11,8 +11,31 @@ import numpy as np
 from tqdm import tqdm
 import json
 import math
-import random
 import os
+import pickle
+import hashlib
+import multiprocessing
+from array import array
+
+try:
+	from numba import njit
+except ImportError:
+	njit = None
+
+try:
+	import ijson
+except ImportError:
+	ijson = None
+
+try:
+	import orjson
+	_json_loads = orjson.loads
+except ImportError:
+	try:
+		import ujson
+		_json_loads = ujson.loads
+	except ImportError:
+		_json_loads = json.loads
 
 # vocab
 PAD_TOKEN = '<PAD>'
@@ -39,7 +62,7 @@ def log2posprob(log_prob):
 
 def load_rel2id(fname):
 	with open(fname, 'r') as f:
-		relation2id = json.load(f)
+		relation2id = _json_loads(f.read())
 		return relation2id
 
 def ensure_dir(d, verbose=True):
@@ -48,107 +71,137 @@ def ensure_dir(d, verbose=True):
 			print("Directory {} do not exist; creating...".format(d))
 		os.makedirs(d)
 
-class Dataset(object):
-	def __init__(self, filename, args, word2id, device, rel2id=None, shuffle=False, batch_size=None, mask_with_type=True, use_mask=True, verbose=True):
+class Dataset(torch.utils.data.Dataset):
+	def __init__(self, filename, args, word2id, device, rel2id=None, shuffle=False, batch_size=None, mask_with_type=True, use_mask=True, verbose=True, pin_memory=torch.cuda.is_available(), use_cache=True, preprocess_workers=None):
 		if batch_size is None:
 			batch_size = args.batch_size
+		if preprocess_workers is None:
+			preprocess_workers = getattr(args, 'preprocess_workers', 0)
 		lower = args.lower
 		self.device = device
-		if isinstance(filename, str):
-			with open(filename, 'r') as f:
-				instances = json.load(f)
-		else:
-			instances = filename
+		self.batch_size = batch_size
+		self.pin_memory = pin_memory
+
+		instances = None if isinstance(filename, str) else filename
 		if rel2id == None:
+			if instances is None:
+				with open(filename, 'r') as f:
+					instances = _json_loads(f.read())
 			self.get_id_maps(instances)
 			rel2id = self.rel2id
 		else:
 			self.rel2id = rel2id
 
-		datasize = len(instances)
-		if shuffle:
-			indices = list(range(datasize))
-			random.shuffle(indices)
-			instances = [instances[i] for i in indices]
-
-		data = []
-		labels = []
+		# reuse preprocessed id lists from a previous run with the same arguments
+		data = labels = None
 		discard = 0
-		rel_cnt = {}
-		# preprocess: convert tokens to id
-		for instance in instances:
-			tokens = instance['token']
-			l = len(tokens)
-			if l > MAXLEN or l != len(instance['stanford_ner']):
-				discard += 1
-				continue
-			if lower:
-				tokens = [t.lower() for t in tokens]
-			# anonymize tokens
-			ss, se = instance['subj_start'], instance['subj_end']
-			os, oe = instance['obj_start'], instance['obj_end']
-			# replace subject and object with typed "placeholder"
-			if use_mask:
-				if mask_with_type:
-					tokens[ss:se + 1] = ['SUBJ-' + instance['subj_type']] * (se - ss + 1)
-					tokens[os:oe + 1] = ['OBJ-' + instance['obj_type']] * (oe - os + 1)
-				else:
-					tokens[ss:se + 1] = ['SUBJ-O'] * (se - ss + 1)
-					tokens[os:oe + 1] = ['OBJ-O'] * (oe - os + 1)
-			tokens = map_to_ids(tokens, word2id)
-			pos = map_to_ids(instance['stanford_pos'], pos2id)
-			ner = map_to_ids(instance['stanford_ner'], ner2id)
-			subj_positions = get_positions(ss, se, l)
-			obj_positions = get_positions(os, oe, l)
-			# if instance['relation'] in self.rel2id and instance['relation'] != 'per:countries_of_residence':
-			if instance['relation'] in self.rel2id:
-				rel = instance['relation']
-				relation = self.rel2id[instance['relation']]
+		cache_file = None
+		if use_cache and isinstance(filename, str):
+			cache_file = get_cache_path(filename, lower, mask_with_type, use_mask, len(word2id), self.rel2id)
+			if os.path.isfile(cache_file):
+				try:
+					with open(cache_file, 'rb') as f:
+						data, labels, discard = pickle.load(f)
+					if verbose:
+						print('Loaded preprocessed instances from %s' % cache_file)
+				except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+					data = labels = None
+
+		if data is None:
+			if instances is None:
+				# stream instance dicts straight into preprocessing; the raw list
+				# is discarded anyway, so never materializing it halves peak RSS
+				instances = iter_instances(filename)
+			data = []
+			labels = []
+			discard = 0
+			# preprocess: convert tokens to id
+			pool = None
+			if preprocess_workers > 1:
+				# instances are independent, so fan the per-instance work out to a
+				# pool; the vocabs ship once via the initializer, not per task
+				pool = multiprocessing.Pool(preprocess_workers, initializer=_pool_init,
+											initargs=(word2id, self.rel2id, lower, mask_with_type, use_mask))
+				instance_ids = pool.imap(_preprocess_one, instances, chunksize=256)
 			else:
-				# relation = self.rel2id['no_relation']
-				discard += 1
-				continue
-			if rel not in rel_cnt:
-				rel_cnt[rel] = 0
-			rel_cnt[rel] += 1
-			data.append((tokens, pos, ner, subj_positions, obj_positions, relation))
-			labels.append(relation)
+				instance_ids = (preprocess_instance(instance, word2id, self.rel2id, lower, mask_with_type, use_mask)
+								for instance in instances)
+			for instance_id in instance_ids:
+				if instance_id is None:
+					discard += 1
+					continue
+				data.append(instance_id)
+				labels.append(instance_id[5])
+			if pool is not None:
+				pool.close()
+				pool.join()
+			if cache_file is not None:
+				try:
+					with open(cache_file, 'wb') as f:
+						pickle.dump((data, labels, discard), f, protocol=pickle.HIGHEST_PROTOCOL)
+				except OSError:
+					pass
 
 		datasize = len(data)
+		if shuffle:
+			perm = np.random.permutation(datasize)
+			data = [data[i] for i in perm]
+			labels = [labels[i] for i in perm]
+
+		rel_cnt = {}
+		for relation in labels:
+			if relation not in rel_cnt:
+				rel_cnt[relation] = 0
+			rel_cnt[relation] += 1
+
 		self.datasize = datasize
+		self.data = data
+		self.labels = labels
 
 		self.log_prior = np.zeros(len(rel2id), dtype=np.float32)
 		self.rel_distrib = np.zeros(len(rel2id), dtype=np.float32)
-		for rel in rel_cnt:
-			relid = rel2id[rel]
-			self.rel_distrib[relid] = rel_cnt[rel]
-			self.log_prior[relid] = np.log(rel_cnt[rel])
+		for relid, cnt in rel_cnt.items():
+			self.rel_distrib[relid] = cnt
+			self.log_prior[relid] = np.log(cnt)
 		max_log = np.max(self.log_prior)
 		self.log_prior = self.log_prior - max_log
 		self.rel_distrib = self.rel_distrib / np.sum(self.rel_distrib)
 
-		# chunk into batches
-		batched_data = [data[i:i + batch_size] for i in range(0, datasize, batch_size)]
 		self.batched_label = [labels[i:i + batch_size] for i in range(0, datasize, batch_size)]
-		self.batched_data = []
-		for batch in batched_data:
-			batch_size = len(batch)
-			batch = list(zip(*batch))
-			assert len(batch) == 6
-			# sort by descending order of lens
-			lens = [len(x) for x in batch[0]]
-			batch, orig_idx = sort_all(batch, lens)
-
-			words = get_padded_tensor(batch[0], batch_size)
-			pos = get_padded_tensor(batch[1], batch_size)
-			ner = get_padded_tensor(batch[2], batch_size)
-			subj_pos = get_padded_tensor(batch[3], batch_size)
-			obj_pos = get_padded_tensor(batch[4], batch_size)
-			relations = torch.tensor(batch[5], dtype=torch.long)
-			self.batched_data.append((words, pos, ner, subj_pos, obj_pos, relations, orig_idx))
+		self._batched_data = None
 
 		if verbose:
-			print('Discard instances: %d, Total instances: %d, Number of batches: %d' % (discard, datasize, len(batched_data)))
+			num_batches = (datasize + batch_size - 1) // batch_size
+			print('Discard instances: %d, Total instances: %d, Number of batches: %d' % (discard, datasize, num_batches))
+
+	def __len__(self):
+		return self.datasize
+
+	def __getitem__(self, index):
+		return self.data[index]
+
+	@property
+	def batched_data(self):
+		""" Batches collated on first access, for consumers iterating the full set in order. """
+		if self._batched_data is None:
+			self._batched_data = []
+			for i in range(0, self.datasize, self.batch_size):
+				batch = collate_fn(self.data[i:i + self.batch_size])
+				if self.pin_memory:
+					# pinned (page-locked) buffers allow async H2D copies with non_blocking=True
+					batch = tuple(t.pin_memory() if isinstance(t, torch.Tensor) else t for t in batch)
+				self._batched_data.append(batch)
+		return self._batched_data
+
+	def loader(self, num_workers=0, shuffle=False):
+		""" Wrap the dataset in a DataLoader, overlapping collation with compute. """
+		kwargs = dict(batch_size=self.batch_size, shuffle=shuffle, collate_fn=collate_fn,
+					  num_workers=num_workers, pin_memory=self.pin_memory)
+		if num_workers > 0:
+			# amortize worker startup over epochs and keep batches queued ahead
+			kwargs['persistent_workers'] = True
+			kwargs['prefetch_factor'] = 2
+		return torch.utils.data.DataLoader(self, **kwargs)
 
 	def get_id_maps(self, instances):
 		print('Getting index maps......')
@@ -163,77 +216,166 @@ class Dataset(object):
 		NO_RELATION = self.rel2id['no_relation']
 		print(self.rel2id)
 
-def get_padded_tensor(tokens_list, batch_size):
-	""" Convert tokens list to a padded Tensor. """
-	token_len = max(len(x) for x in tokens_list)
-	pad_len = min(token_len, MAXLEN)
-	tokens = torch.zeros(batch_size, pad_len, dtype=torch.long).fill_(PAD_ID)
-	for i, s in enumerate(tokens_list):
-		cur_len = min(pad_len, len(s))
-		tokens[i, :cur_len] = torch.tensor(s[:cur_len], dtype=torch.long)
-	return tokens
+def iter_instances(filename):
+	""" Iterate instances from a JSON array file, streaming when ijson is available. """
+	if ijson is not None:
+		with open(filename, 'rb') as f:
+			for instance in ijson.items(f, 'item'):
+				yield instance
+	else:
+		with open(filename, 'r') as f:
+			for instance in _json_loads(f.read()):
+				yield instance
+
+def get_cache_path(filename, lower, mask_with_type, use_mask, vocab_size, rel2id):
+	""" Cache file path keyed by the source file and preprocessing arguments. """
+	key = (os.path.getmtime(filename), lower, mask_with_type, use_mask, vocab_size, sorted(rel2id.items()), MAXLEN)
+	digest = hashlib.md5(repr(key).encode('utf-8')).hexdigest()[:12]
+	return '%s.%s.cache.pkl' % (filename, digest)
+
+_pool_args = None
+
+def _pool_init(word2id, rel2id, lower, mask_with_type, use_mask):
+	global _pool_args
+	_pool_args = (word2id, rel2id, lower, mask_with_type, use_mask)
+
+def _preprocess_one(instance):
+	return preprocess_instance(instance, *_pool_args)
+
+def preprocess_instance(instance, word2id, rel2id, lower, mask_with_type=True, use_mask=True):
+	""" Convert one raw instance to id lists, or None if it should be discarded. """
+	tokens = instance['token']
+	l = len(tokens)
+	# run every discard predicate before any per-token work
+	if l > MAXLEN or l != len(instance['stanford_ner']) or instance['relation'] not in rel2id:
+		return None
+	relation = rel2id[instance['relation']]
+	if lower:
+		tokens = [t.lower() for t in tokens]
+	# anonymize tokens
+	ss, se = instance['subj_start'], instance['subj_end']
+	os, oe = instance['obj_start'], instance['obj_end']
+	tokens, pos, ner = map3_to_ids(tokens, instance['stanford_pos'], instance['stanford_ner'], word2id)
+	# replace subject and object with a typed "placeholder": the placeholder id is
+	# looked up once and written over the id slices, so the mask string is never
+	# materialized (or re-hashed) per masked token
+	if use_mask:
+		if mask_with_type:
+			subj_id = word2id.get('SUBJ-' + instance['subj_type'], UNK_ID)
+			obj_id = word2id.get('OBJ-' + instance['obj_type'], UNK_ID)
+		else:
+			subj_id = word2id.get('SUBJ-O', UNK_ID)
+			obj_id = word2id.get('OBJ-O', UNK_ID)
+		tokens[ss:se + 1] = [subj_id] * (se - ss + 1)
+		tokens[os:oe + 1] = [obj_id] * (oe - os + 1)
+	subj_positions = get_positions(ss, se, l)
+	obj_positions = get_positions(os, oe, l)
+	return tokens, pos, ner, subj_positions, obj_positions, relation
+
+def collate_fn(batch):
+	""" Collate per-instance id lists into one padded int32 feature buffer. """
+	batch_size = len(batch)
+	batch = list(zip(*batch))
+	assert len(batch) == 6
+	# no sorting here: pack_padded_sequence(..., enforce_sorted=False) sorts once
+	# on the C++ side, so predictions stay in input order
+	lens = [len(x) for x in batch[0]]
+
+	pad_len = min(max(lens), MAXLEN)
+	# round up to a multiple of 8 so cuDNN can pick Tensor Core kernels under AMP
+	pad_len = min(MAXLEN, ((pad_len + 7) // 8) * 8)
+	# words/pos/ner/subj_pos/obj_pos as planes of one contiguous buffer: a single
+	# H2D copy moves the whole batch, at half the bandwidth of five int64 tensors
+	feats = np.full((batch_size, 5, pad_len), PAD_ID, dtype=np.int32)
+	for plane, field in enumerate(batch[:5]):
+		for i, s in enumerate(field):
+			cur_len = min(pad_len, len(s))
+			feats[i, plane, :cur_len] = s[:cur_len]
+	feats = torch.from_numpy(feats)
+	# np.fromiter unboxes the Python ints once; as_tensor wraps the buffer zero-copy
+	relations = torch.as_tensor(np.fromiter(batch[5], dtype=np.int64, count=batch_size))
+	lens = torch.as_tensor(np.fromiter(lens, dtype=np.int64, count=batch_size))
+	return feats, relations, lens
+
+def unpack_feats(feats):
+	""" Split the collated feature buffer into the five int64 model inputs. """
+	# embedding lookups need int64; the casts are cheap and run on-device
+	return [feats[:, i].long() for i in range(5)]
 
 def get_cv_dataset(filename, args, word2id, device, rel2id, dev_ratio=0.2):
 	with open(filename, 'r') as f:
-		instances = json.load(f)
+		instances = _json_loads(f.read())
 
 	datasize = len(instances)
 	dev_cnt = math.ceil(datasize * dev_ratio)
 
-	indices = list(range(datasize))
-	random.shuffle(indices)
-	instances = [instances[i] for i in indices]
-
-	dev_instances = instances[:dev_cnt]
-	test_instances = instances[dev_cnt:]
+	# split on a C-level permutation directly, skipping the shuffled full copy
+	perm = np.random.permutation(datasize)
+	dev_instances = [instances[i] for i in perm[:dev_cnt]]
+	test_instances = [instances[i] for i in perm[dev_cnt:]]
 
 	dev_dset = Dataset(dev_instances, args, word2id, device, rel2id, verbose=False)
 	test_dset = Dataset(test_instances, args, word2id, device, rel2id, verbose=False)
 	return dev_dset, test_dset
 
 
-def map_to_ids(tokens, vocab):
-		ids = [vocab[t] if t in vocab else UNK_ID for t in tokens]
-		return ids
-
-def get_positions(start_idx, end_idx, length):
+def map_to_ids(tokens, vocab, _unk=UNK_ID):
+		get = vocab.get
+		return [get(t, _unk) for t in tokens]
+
+def map3_to_ids(tokens, pos_tags, ner_tags, word2id, _unk=UNK_ID):
+	""" Map the parallel token/POS/NER sequences to ids in a single pass. """
+	l = len(tokens)
+	token_ids = [0] * l
+	pos_ids = [0] * l
+	ner_ids = [0] * l
+	get_word = word2id.get
+	get_pos = pos2id.get
+	get_ner = ner2id.get
+	for i in range(l):
+		token_ids[i] = get_word(tokens[i], _unk)
+		pos_ids[i] = get_pos(pos_tags[i], _unk)
+		ner_ids[i] = get_ner(ner_tags[i], _unk)
+	return token_ids, pos_ids, ner_ids
+
+if njit is not None:
+	@njit(cache=True)
+	def _fill_positions(start_idx, end_idx, length, out):
+		for i in range(start_idx):
+			out[i] = i - start_idx
+		for i in range(start_idx, end_idx + 1):
+			out[i] = 0
+		for i in range(end_idx + 1, length):
+			out[i] = i - end_idx
+
+	def get_positions(start_idx, end_idx, length):
 		""" Get subj/obj relative position sequence. """
-		return list(range(-start_idx, 0)) + [0]*(end_idx - start_idx + 1) + \
-			   list(range(1, length-end_idx))
-
-def sort_all(batch, lens):
-	""" Sort all fields by descending order of lens, and return the original indices. """
-	unsorted_all = [lens] + [range(len(lens))] + list(batch)
-	sorted_all = [list(t) for t in zip(*sorted(zip(*unsorted_all), reverse=True))]
-	return sorted_all[2:], sorted_all[1]
-
-def recover_idx(orig_idx):
-	orig2now = [0]*len(orig_idx)
-	for idx, orig in enumerate(orig_idx):
-		orig2now[orig] = idx
-	return orig2now
+		positions = np.empty(length, dtype=np.int64)
+		_fill_positions(start_idx, end_idx, length, positions)
+		return positions
+else:
+	def get_positions(start_idx, end_idx, length):
+		""" Get subj/obj relative position sequence. """
+		# preallocate one C int64 buffer and slice-assign the two ranges, instead
+		# of concatenating three Python lists; NumPy wraps the buffer zero-copy
+		positions = array('q', [0]) * length
+		positions[:start_idx] = array('q', range(-start_idx, 0))
+		positions[end_idx + 1:] = array('q', range(1, length - end_idx))
+		return positions
 
 def eval(pred, labels, weights):
-	correct_by_relation = 0
-	guessed_by_relation = 0
-	gold_by_relation = 0
-
-	# Loop over the data to compute a score
-	for idx in range(len(pred)):
-		gold = labels[idx]
-		guess = pred[idx]
-
-		if gold == NO_RELATION and guess == NO_RELATION:
-			pass
-		elif gold == NO_RELATION and guess != NO_RELATION:
-			guessed_by_relation += weights[gold]
-		elif gold != NO_RELATION and guess == NO_RELATION:
-			gold_by_relation += weights[gold]
-		elif gold != NO_RELATION and guess != NO_RELATION:
-			guessed_by_relation += weights[gold]
-			gold_by_relation += weights[gold]
-			if gold == guess:
-				correct_by_relation += weights[gold]
+	pred = np.asarray(pred)
+	labels = np.asarray(labels)
+	weights = np.asarray(weights, dtype=np.float64)
+
+	# boolean masks over the whole set replace the per-instance branching;
+	# every term is weighted by the gold label's weight, as before
+	w_gold = weights[labels]
+	guess_nz = pred != NO_RELATION
+	gold_nz = labels != NO_RELATION
+	guessed_by_relation = w_gold[guess_nz].sum()
+	gold_by_relation = w_gold[gold_nz].sum()
+	correct_by_relation = w_gold[guess_nz & gold_nz & (pred == labels)].sum()
 
 	prec = 0.0
 	if guessed_by_relation > 0:
@@ -251,8 +393,9 @@ def eval(pred, labels, weights):
 def calcEntropy(batch_scores):
 	# input: B * L
 	# output: B
-	batch_probs = nn.functional.softmax(batch_scores)
-	return torch.sum(batch_probs * torch.log(batch_probs), dim=1).neg()
+	# log_softmax is stable at extreme logits, unlike softmax followed by log
+	log_probs = nn.functional.log_softmax(batch_scores, dim=1)
+	return torch.sum(log_probs.exp() * log_probs, dim=1).neg()
 
 def calcInd(batch_probs):
 	# input: B * L
@@ -265,5 +408,7 @@ def keep_partial_grad(grad, topk):
     Keep only the topk rows of grads.
     """
     assert topk < grad.size(0)
-    grad.data[topk:].zero_()
+    # narrow() yields a view without the deprecated .data traversal or an
+    # intermediate indexing kernel; one zero_() launch clears the tail rows
+    grad.narrow(0, topk, grad.size(0) - topk).zero_()
     return grad